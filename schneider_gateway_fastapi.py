@@ -1,17 +1,77 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-import requests
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict, Field
+import httpx
+import asyncio
 import json
-import time
+import orjson
 import base64
-from typing import Dict, Any, Optional
+import contextlib
+import copy
+import errno
+import functools
+import itertools
+import os
+import random
+import stat
+import sys
+import tempfile
+import logging
+import logging.handlers
+import queue
+from typing import Dict, Any, List, Optional, Tuple, Union
 import yaml
 
+# Fallback for starts that bypass uvicorn's --loop uvloop; uvloop.install() is
+# deprecated from Python 3.12, where asyncio.Runner(loop_factory=...) replaces it
+if sys.version_info < (3, 12):
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
+# Use the libyaml C loader when PyYAML was built with it
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# The level comes from the logging config (root or "schneider_gateway" logger).
+# When nothing has configured the root logger, records at INFO and above are handed
+# to a queue and written to stderr by a listener thread, so handlers never block on
+# console I/O.
+logger = logging.getLogger("schneider_gateway")
+
+log_queue = queue.SimpleQueue()
+log_queue_handler = logging.handlers.QueueHandler(log_queue)
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+
+def start_logging():
+    if not logging.getLogger().handlers:
+        # Keep INFO records like "Login successful" visible unless a level was configured
+        if logger.level == logging.NOTSET:
+            logger.setLevel(logging.INFO)
+        logger.addHandler(log_queue_handler)
+        log_listener.start()
+
+def stop_logging():
+    if log_queue_handler in logger.handlers:
+        logger.removeHandler(log_queue_handler)
+        log_listener.stop()
+
+# Seconds between proactive background logins that keep the cookie fresh
+REFRESH_INTERVAL = 600
+# Random extra delay per refresh so workers started together don't log in at once
+REFRESH_JITTER = 60
+# Upper bound on commands accepted by a single /control_devices request
+MAX_BATCH_SIZE = 100
+
 app = FastAPI(
     title="Schneider Gateway API",
     description="API for controlling and monitoring Schneider Gateway devices",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
 )
 
 app.add_middleware(
@@ -23,33 +83,71 @@ app.add_middleware(
 )
 
 class DeviceControl(BaseModel):
+    model_config = ConfigDict(extra="forbid", frozen=True)
+
     device_name: str
     action: str
     level: Optional[int] = None
     ac_mode: Optional[str] = None
     temperature: Optional[int] = None
 
+class DeviceControlBatch(BaseModel):
+    items: List[DeviceControl] = Field(..., max_length=MAX_BATCH_SIZE)
+
+@app.on_event("startup")
+async def startup():
+    start_logging()
+    backend.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await backend.close()
+    stop_logging()
+
 @app.post("/control_device")
 async def control_device(device_control: DeviceControl):
     try:
-        result = backend.control_device(
+        result = await backend.control_device(
             device_control.device_name, 
             device_control.action, 
             device_control.level,
             device_control.ac_mode,
             device_control.temperature
         )
-        return {"status": "success", "result": result}
+        return ORJSONResponse({"status": "success", "result": result})
     except HTTPException as e:
         raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/control_devices")
+async def control_devices(batch: DeviceControlBatch):
+    results = await asyncio.gather(*(
+        backend.control_device(
+            item.device_name,
+            item.action,
+            item.level,
+            item.ac_mode,
+            item.temperature
+        ) for item in batch.items
+    ), return_exceptions=True)
+
+    # Report failures per item so one bad command doesn't fail the whole batch
+    response = []
+    for result in results:
+        if isinstance(result, HTTPException):
+            response.append({"status": "error", "status_code": result.status_code, "detail": result.detail})
+        elif isinstance(result, BaseException):
+            response.append({"status": "error", "status_code": 500, "detail": str(result)})
+        else:
+            response.append({"status": "success", "result": result})
+    return ORJSONResponse(response)
+
 @app.get("/device_status/{device_name}")
 async def get_device_status(device_name: str):
     try:
-        result = backend.read_device_status(device_name)
-        return {"status": "success", "result": result}
+        result = await backend.read_device_status(device_name)
+        return ORJSONResponse({"status": "success", "result": result})
     except HTTPException as e:
         raise e
     except Exception as e:
@@ -57,13 +155,16 @@ async def get_device_status(device_name: str):
 
 @app.get("/devices")
 async def get_devices():
-    return {"devices": [
-        {
-            "name": name,
-            "location": device["location"],
-            "type": device["type"]
-        } for name, device in backend.config['devices'].items()
-    ]}
+    return ORJSONResponse({"devices": backend.get_devices()})
+
+@functools.lru_cache(maxsize=1)
+def _parse_config(config_file: str) -> Dict[str, Any]:
+    with open(config_file, 'r') as file:
+        return yaml.load(file, Loader=YamlLoader)
+
+def load_config(config_file: str) -> Dict[str, Any]:
+    # Hand out a copy so callers mutating their config don't alter the cached parse
+    return copy.deepcopy(_parse_config(config_file))
 
 class SchneiderGatewayBackend:
     def __init__(self, config_file: str):
@@ -73,125 +174,253 @@ class SchneiderGatewayBackend:
         self.cookie = self.config.get('cookie', '')
         self.username = self.config['username']
         self.password = self.config['password']
+        self._auth_header = {
+            'Authorization': "Basic " + base64.b64encode(f"{self.username}:{self.password}".encode()).decode()
+        }
+        self._cookie_header = {'Cookie': f'user_id={self.cookie}'}
+        self._devices = self._build_devices()
+        self._trans_id = itertools.count(1)
+        self._dispatch = self._build_dispatch()
+        # The lock is created on first use so it binds to the running event loop
+        self._login_lock = None
+        self._refresh_task = None
+        # Status reads currently in flight, shared by concurrent callers
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+        # One keep-alive client so gateway calls don't block the event loop.
+        # The transport retries failed connects; 5xx replies are not retried
+        # since commands like IR sends aren't safe to repeat.
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url,
+            transport=httpx.AsyncHTTPTransport(
+                retries=2,
+                limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
+            ),
+            timeout=5.0,
+            headers=self._auth_header,
+        )
+
+    def start(self):
+        self._refresh_task = asyncio.create_task(self._cookie_refresher())
+
+    async def close(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._refresh_task
+            self._refresh_task = None
+        await self.client.aclose()
 
     def load_config(self) -> Dict[str, Any]:
-        with open(self.config_file, 'r') as file:
-            return yaml.safe_load(file)
+        return load_config(self.config_file)
 
     def save_config(self):
-        with open(self.config_file, 'w') as file:
-            yaml.dump(self.config, file)
-
-    def get_auth_header(self):
-        auth = base64.b64encode(f"{self.username}:{self.password}".encode()).decode()
-        return f"Basic {auth}"
-
-    def is_cookie_valid(self) -> bool:
-        url = f"{self.base_url}/home.html"
-        headers = {
-            'Cookie': f'user_id={self.cookie}',
-            'Authorization': self.get_auth_header()
-        }
-        response = requests.get(url, headers=headers)
-        return response.status_code == 200
+        # Resolve symlinks so the link's target is updated, not replaced
+        path = os.path.realpath(self.config_file)
+        try:
+            self._replace_config(path)
+        except OSError as e:
+            # A bind-mounted file can't be renamed over and a read-only directory
+            # can't hold the temp file; fall back to writing in place
+            if e.errno not in (errno.EBUSY, errno.EXDEV, errno.EACCES, errno.EPERM, errno.EROFS):
+                raise
+            with open(path, 'w') as file:
+                yaml.dump(self.config, file)
+        _parse_config.cache_clear()
+        self._devices = self._build_devices()
+
+    def _replace_config(self, path: str):
+        # Write a temp file and rename it over the config so concurrent workers
+        # never leave a half-written config.yaml behind
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as file:
+                yaml.dump(self.config, file)
+            # mkstemp creates the file as 0600; keep the config's existing mode
+            with contextlib.suppress(FileNotFoundError):
+                os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode))
+            os.replace(tmp_path, path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp_path)
+            raise
+
+    def _build_devices(self) -> Tuple[Dict[str, Any], ...]:
+        return tuple(
+            {
+                "name": name,
+                "location": device["location"],
+                "type": device["type"]
+            } for name, device in self.config['devices'].items()
+        )
+
+    def get_devices(self) -> Tuple[Dict[str, Any], ...]:
+        return self._devices
 
-    def login(self):
-        url = f"{self.base_url}/cgi-bin/admin"
-        headers = self.get_auth_header()
-        response = requests.get(url, headers=headers)
+    def _build_dispatch(self) -> Dict[Tuple[str, str, Optional[Union[str, int]]], Tuple[str, Dict[str, Any]]]:
+        # Resolve every supported (device, action, mode/temperature) to its RPC up front
+        dispatch = {}
+        for name, device in self.config['devices'].items():
+            # Leave unsupported or incomplete entries out so only requests to them fail
+            if device.get('type') not in ('DIMMER', 'SWITCH', 'AC') or 'entity' not in device:
+                continue
+            entity = device['entity']
+            if device['type'] in ('DIMMER', 'SWITCH'):
+                dispatch[(name, 'on', None)] = ("RPC_ZCL_Set_OnOffTog", {"entity": entity, "action": 1})
+                dispatch[(name, 'off', None)] = ("RPC_ZCL_Set_OnOffTog", {"entity": entity, "action": 0})
+            if device['type'] == 'DIMMER':
+                # level is filled in per call
+                dispatch[(name, 'dim', None)] = ("RPC_ZCL_Move_To", {"entity": entity, "level": None, "transTime": 0})
+            elif device['type'] == 'AC':
+                for code_name, ir_code in (device.get('ir_codes') or {}).items():
+                    if code_name == 'power_on':
+                        key = (name, 'on', None)
+                    elif code_name == 'power_off':
+                        key = (name, 'off', None)
+                    elif code_name.endswith('_mode'):
+                        key = (name, 'set_mode', code_name[:-len('_mode')])
+                    elif code_name.startswith('temp_') and code_name[len('temp_'):].isdigit():
+                        key = (name, 'set_temperature', int(code_name[len('temp_'):]))
+                    else:
+                        continue
+                    dispatch[key] = ("RPC_ZCL_Send_IR_Code", {
+                        "entity": entity,
+                        "index": 1,
+                        "repeat": 0,
+                        "codeType": 0,
+                        "irCode": ir_code
+                    })
+        return dispatch
+
+    def get_auth_header(self) -> Dict[str, str]:
+        return self._auth_header
+
+    async def login(self):
+        response = await self.client.get("/cgi-bin/admin")
         if response.status_code == 200:
-            self.cookie = response.cookies.get('user_id', '')
-            self.config['cookie'] = self.cookie
-            self.save_config()
-            print("Login successful")
+            cookie = response.cookies.get('user_id', '')
+            if cookie != self.cookie:
+                self._set_cookie(cookie)
+                # Write the file in a thread so disk I/O doesn't stall the event loop.
+                # The new cookie is already in use, so a failed save must not fail the login.
+                try:
+                    await asyncio.to_thread(self.save_config)
+                except Exception as e:
+                    logger.warning("Could not save cookie to %s: %s", self.config_file, e)
+            logger.info("Login successful")
         else:
-            print("Login failed")
+            logger.warning("Login failed with status %s", response.status_code)
             raise HTTPException(status_code=401, detail="Login failed")
     
-    def control_device(self, device_name: str, action: str, level: Optional[int] = None, ac_mode: Optional[str] = None, temperature: Optional[int] = None):
-        if not self.is_cookie_valid():
-            self.login()
+    async def refresh_cookie(self, stale_cookie: str):
+        if self._login_lock is None:
+            self._login_lock = asyncio.Lock()
+        async with self._login_lock:
+            # Another caller may have logged in while we waited for the lock
+            if self.cookie != stale_cookie:
+                return
+            # Another worker may have logged in and saved a newer cookie; reuse it
+            # rather than logging in again and invalidating theirs
+            saved_cookie = await asyncio.to_thread(self._read_saved_cookie)
+            if saved_cookie and saved_cookie != stale_cookie:
+                self._set_cookie(saved_cookie)
+                return
+            await self.login()
 
-        device_config = self.config['devices'].get(device_name)
-        if not device_config:
-            raise HTTPException(status_code=404, detail=f"Device {device_name} not found in configuration")
+    def _read_saved_cookie(self) -> str:
+        with open(self.config_file, 'r') as file:
+            return str(yaml.load(file, Loader=YamlLoader).get('cookie', ''))
 
-        url = f"{self.base_url}/cgi-bin/rpc_bridge"
-        
-        if device_config['type'] == 'DIMMER':
-            if action == 'on':
-                method = "RPC_ZCL_Set_OnOffTog"
-                params = {"entity": device_config['entity'], "action": 1}
-            elif action == 'off':
-                method = "RPC_ZCL_Set_OnOffTog"
-                params = {"entity": device_config['entity'], "action": 0}
-            elif action == 'dim':
-                if level is None:
-                    raise HTTPException(status_code=400, detail="Level is required for dimming")
-                method = "RPC_ZCL_Move_To"
-                params = {"entity": device_config['entity'], "level": level, "transTime": 0}
-            else:
-                raise HTTPException(status_code=400, detail="Invalid action for DIMMER")
-        elif device_config['type'] == 'SWITCH':
-            if action not in ['on', 'off']:
-                raise HTTPException(status_code=400, detail="Invalid action for SWITCH")
-            method = "RPC_ZCL_Set_OnOffTog"
-            params = {"entity": device_config['entity'], "action": 1 if action == 'on' else 0}
-        elif device_config['type'] == 'AC':
-            method = "RPC_ZCL_Send_IR_Code"
-            ir_code = []
-            if action == 'on':
-                ir_code = device_config['ir_codes']['power_on']
-            elif action == 'off':
-                ir_code = device_config['ir_codes']['power_off']
-            elif action == 'set_mode':
-                if ac_mode == 'cool':
-                    ir_code = device_config['ir_codes']['cool_mode']
-                elif ac_mode == 'heat':
-                    ir_code = device_config['ir_codes']['heat_mode']
-                # Add more modes as needed
-            elif action == 'set_temperature':
-                if temperature is not None:
-                    ir_code = device_config['ir_codes'].get(f'temp_{temperature}', [])
-            
-            params = {
-                "entity": device_config['entity'],
-                "index": 1,
-                "repeat": 0,
-                "codeType": 0,
-                "irCode": ir_code
-            }
-        else:
-            raise HTTPException(status_code=400, detail="Unsupported device type")
+    def _set_cookie(self, cookie: str):
+        self.cookie = cookie
+        self._cookie_header = {'Cookie': f'user_id={self.cookie}'}
+        self.config['cookie'] = self.cookie
+
+    async def _cookie_refresher(self):
+        while True:
+            await asyncio.sleep(REFRESH_INTERVAL + random.uniform(0, REFRESH_JITTER))
+            try:
+                await self.refresh_cookie(self.cookie)
+            except Exception as e:
+                logger.warning("Background login failed: %s", e)
 
+    async def _post_rpc(self, payload: Dict[str, Any]) -> httpx.Response:
+        headers = {**self._cookie_header, 'Content-Type': 'application/json'}
+        return await self.client.post("/cgi-bin/rpc_bridge", headers=headers, content=orjson.dumps(payload))
+
+    async def _rpc(self, method: str, params: Dict[str, Any]) -> httpx.Response:
         payload = {
             "jsonrpc": "2.0",
             "method": method,
             "params": params,
-            "transId": int(time.time())
-        }
-        
-        headers = {
-            'Cookie': f'user_id={self.cookie}',
-            'Content-Type': 'application/json',
-            'Authorization': self.get_auth_header()
+            "transId": next(self._trans_id)
         }
 
-        response = requests.post(url, headers=headers, json=payload)
+        cookie = self.cookie
+        response = await self._post_rpc(payload)
+        if response.status_code in (401, 403):
+            # Cookie was rejected, log in once and retry with the new one
+            await self.refresh_cookie(cookie)
+            response = await self._post_rpc(payload)
+        return response
+
+    async def control_device(self, device_name: str, action: str, level: Optional[int] = None, ac_mode: Optional[str] = None, temperature: Optional[int] = None):
+        logger.debug("Controlling device %s with action %s", device_name, action)
+        device_config = self.config['devices'].get(device_name)
+        if not device_config:
+            raise HTTPException(status_code=404, detail=f"Device {device_name} not found in configuration")
+
+        if device_config['type'] not in ('DIMMER', 'SWITCH', 'AC'):
+            raise HTTPException(status_code=400, detail="Unsupported device type")
+
+        if action == 'set_mode':
+            sub_key = ac_mode
+        elif action == 'set_temperature':
+            sub_key = temperature
+        else:
+            sub_key = None
+
+        entry = self._dispatch.get((device_name, action, sub_key))
+        if entry is None:
+            raise HTTPException(status_code=400, detail=f"Invalid action for {device_config['type']}")
+        method, template = entry
+
+        params = dict(template)
+        if action == 'dim':
+            if level is None:
+                raise HTTPException(status_code=400, detail="Level is required for dimming")
+            params['level'] = level
+
+        response = await self._rpc(method, params)
         if response.status_code != 200:
             raise HTTPException(status_code=response.status_code, detail="Device control failed")
-        return response.json()
+        return orjson.loads(response.content)
 
-    def read_device_status(self, device_name: str):
-        if not self.is_cookie_valid():
-            self.login()
+    async def read_device_status(self, device_name: str):
+        inflight = self._inflight.get(device_name)
+        if inflight is not None:
+            # shield so one caller going away doesn't cancel the read for the others
+            return await asyncio.shield(inflight)
 
+        task = asyncio.ensure_future(self._read_device_status(device_name))
+        self._inflight[device_name] = task
+        # Tie the entry to the read itself, not to whichever caller started it
+        task.add_done_callback(lambda done: self._forget_inflight(device_name, done))
+        return await asyncio.shield(task)
+
+    def _forget_inflight(self, device_name: str, task: asyncio.Future):
+        if self._inflight.get(device_name) is task:
+            del self._inflight[device_name]
+        # Nobody may be left awaiting the read; retrieve its error to avoid a warning
+        if not task.cancelled():
+            task.exception()
+
+    async def _read_device_status(self, device_name: str):
+        logger.debug("Reading status of device %s", device_name)
         device_config = self.config['devices'].get(device_name)
         if not device_config:
             raise HTTPException(status_code=404, detail=f"Device {device_name} not found in configuration")
 
-        url = f"{self.base_url}/cgi-bin/rpc_bridge"
-        
         if device_config['type'] == 'DIMMER':
             methods = ["RPC_ZCL_Get_OnOff", "RPC_ZCL_Get_Level"]
         elif device_config['type'] == 'SWITCH':
@@ -199,25 +428,17 @@ class SchneiderGatewayBackend:
         else:
             raise HTTPException(status_code=400, detail="Unsupported device type")
 
+        # Fire all status reads at once so latency is that of the slowest call
+        coros = [self._rpc(method, {"entity": device_config['entity']}) for method in methods]
+        responses = await asyncio.gather(*coros, return_exceptions=True)
+
         results = {}
-        for method in methods:
-            payload = {
-                "jsonrpc": "2.0",
-                "method": method,
-                "params": {"entity": device_config['entity']},
-                "transId": int(time.time())
-            }
-            
-            headers = {
-                'Cookie': f'user_id={self.cookie}',
-                'Content-Type': 'application/json',
-                **self.get_auth_header()
-            }
-
-            response = requests.post(url, headers=headers, json=payload)
+        for method, response in zip(methods, responses):
+            if isinstance(response, BaseException):
+                raise response
             if response.status_code != 200:
                 raise HTTPException(status_code=response.status_code, detail="Device status read failed")
-            results[method] = response.json()
+            results[method] = orjson.loads(response.content)
 
         return results
 